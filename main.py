@@ -1,9 +1,12 @@
-from configparser import ConfigParser
-import re
+import ctypes
+import errno
+import heapq
+import os
 import sys
 import time
-import select
+import selectors
 import socket
+import struct
 
 """
 Authors: Quin Burrell and Alex McCarty
@@ -13,77 +16,262 @@ Purpose: Takes a configuration file as an argument in the commandline and sets u
  running concurrently in the same machine.
 """
 
+config_cache = {}  # Parsed config files, keyed by their path, modification time and size
+ERROR_TEXT = {  # The error message for each error code
+    0: "Please enter a value between 1 and 64000",
+    1: "Your input ports do not match your output ports. Please update your configuration file",
+    2: "Please make sure you do not have the same entry in your input and output port fields",
+    3: "Please make sure your port numbers are between 1024 and 64000",
+    4: "Failed to initialise sockets",
+    5: "ROUTINGD_CORE must be the number of a CPU this router is allowed to run on",
+    10: "Packet contains less than one RIP Entry",
+    11: "RIP Packet header incorrect",
+    12: "Packet contains fragments",
+    13: "Given metric is out of range",
+    20: "An error on the socket"
+}
+RIP_HEADER = b'\x02\x02\x00\x00'  # The RIP header: a response command, version 2 and two zero bytes
+HEADER_WORD = struct.Struct('>I')  # The RIP header read as one 4 byte word, so checking it needs no slice
+RIP_HEADER_VALUE = HEADER_WORD.unpack(RIP_HEADER)[0]
+RIP_ENTRY = struct.Struct('>4xI8xI')  # A 20 byte RIP entry holding the router id and the metric
+UNREACHABLE_METRIC = struct.pack('>I', 16)  # The last 4 bytes of a RIP entry for an unreachable router
+ROUTE_TIMEOUT = 30  # Seconds without hearing about a route before it is marked unreachable
+UPDATE_INTERVAL = 10  # Seconds between the periodic updates sent to the neighbours
+# Socket buffer sizes, large enough to absorb a burst of updates. Linux caps these at net.core.rmem_max and
+# net.core.wmem_max, so those may need raising as well, e.g. sysctl -w net.core.rmem_max=12582912
+RECV_BUFFER_SIZE = 4 * 1024 * 1024
+SEND_BUFFER_SIZE = 1024 * 1024
+LOCALHOST = '127.0.0.1'  # The neighbours' address, given numerically so sending skips the host name lookup
+RECV_SIZE = 1024  # The largest packet that is received
+RECV_BATCH = 16  # The most packets taken from a socket in one recvmmsg call
+CORE_ENV = 'ROUTINGD_CORE'  # The environment variable naming the CPU the router is pinned to, if any
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)  # Not exposed by every Python build, 46 is its value on Linux
+BUSY_POLL_USECS = 50  # Microseconds the kernel busy polls for a packet before a blocking receive sleeps
+ON_LINUX = sys.platform.startswith('linux')  # The batched socket calls and busy polling are Linux only
+# The C library, for the batched socket calls that Python does not expose. Only used on Linux
+libc = ctypes.CDLL(None, use_errno=True) if ON_LINUX else None
+
+
+class IoVec(ctypes.Structure):
+    """struct iovec, a buffer to send or receive into"""
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class SockAddrIn(ctypes.Structure):
+    """struct sockaddr_in, an IPv4 address and port in network byte order"""
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16), ('sin_addr', ctypes.c_uint32),
+                ('sin_zero', ctypes.c_char * 8)]
+
+
+class MsgHdr(ctypes.Structure):
+    """struct msghdr, the address and buffers of one datagram"""
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(IoVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t), ('msg_flags', ctypes.c_int)]
+
+
+class MMsgHdr(ctypes.Structure):
+    """struct mmsghdr, one datagram of a sendmmsg or recvmmsg call"""
+    _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+
 
 class RipEntry:
     """An object that represents all the information about the router for an RIP Entry"""
+    __slots__ = ('router_id', 'metric', 'next_hop', 'timer', 'packet', 'packet_metric', 'unreachable_packet')
 
     def __init__(self, router_id, metric, next_hop, timer):
         self.router_id = router_id
         self.metric = metric
         self.next_hop = next_hop
         self.timer = timer
+        self.packet = None  # The encoded entry, cached along with the metric it was built for
+        self.packet_metric = None
+        self.unreachable_packet = RIP_ENTRY.pack(router_id, 16)  # The entry as advertised back to its next hop
 
     def build_packet(self):
-        return ([0] * 7) + [self.router_id] + ([0] * 11) + [self.metric]
+        if self.packet_metric != self.metric:  # Only re-encodes the entry once its metric has changed
+            self.packet = RIP_ENTRY.pack(self.router_id, self.metric)
+            self.packet_metric = self.metric
+        return self.packet
+
+
+class RoutingTable(list):
+    """A list of RipEntry obj, one for each router that this router is aware of, starting with this router. by_id
+    looks the entries up by router id. changed must be set whenever an entry's metric or next hop changes so that the
+    packets sent to the neighbours, which are kept until then, get rebuilt. Timers must be started with set_timer so
+    that timeout_check can find them"""
+
+    def __init__(self, entries):
+        super().__init__(entries)
+        self.by_id = {entry.router_id: entry for entry in self}
+        self.changed = True
+        self.packets = {}  # The packet last built for each receiver
+        self.base_packet = None  # The packet with no routes poisoned, that the receivers' packets are made from
+        self.hop_offsets = {}  # The offsets in the packet of the metrics of the routes through each next hop
+        # A heap of (time out, router id) with at most one time out for each router. A timer restarted after its time
+        # out was added is still running when that time out comes round, and timeout_check then moves it on
+        self.deadlines = []
+        self.scheduled = set()  # The router ids with a time out in deadlines
+        for entry in self:
+            self.schedule(entry)
+
+    def append(self, entry):
+        super().append(entry)
+        self.by_id[entry.router_id] = entry
+        self.changed = True
+        self.schedule(entry)
+
+    def schedule(self, entry):
+        """adds the time out of the entry's timer to deadlines if it is running and does not have one there yet"""
+        if entry.timer != 0 and entry.router_id not in self.scheduled:
+            self.scheduled.add(entry.router_id)
+            heapq.heappush(self.deadlines, (entry.timer + ROUTE_TIMEOUT, entry.router_id))
+
+    def set_timer(self, entry, now):
+        """restarts the entry's timer from now"""
+        entry.timer = now
+        self.schedule(entry)
+
+    def packet(self, receiver):
+        """returns the packet to send to the receiver, only building it again if the table has changed since. Rather
+        than building it from the entries, the table's packet is copied and the routes through the receiver are set
+        to unreachable"""
+        if self.changed:
+            self.packets.clear()
+            self.base_packet = rip_packet(self, None)  # None is no entry's next hop, so no route is poisoned
+            self.hop_offsets = {}
+            for i, entry in enumerate(self):
+                self.hop_offsets.setdefault(entry.next_hop, []).append(4 + 20 * i + 16)
+            self.changed = False
+        if receiver not in self.packets:
+            offsets = self.hop_offsets.get(receiver)
+            if offsets:
+                packet = bytearray(self.base_packet)
+                for offset in offsets:
+                    packet[offset:offset + 4] = UNREACHABLE_METRIC
+                self.packets[receiver] = bytes(packet)
+            else:  # No routes go through the receiver, so it can be sent the table's packet as it is
+                self.packets[receiver] = self.base_packet
+        return self.packets[receiver]
+
+
+class PacketReceiver:
+    """Receives the packets waiting on a socket into a buffer that is allocated once and reused, handing them out as
+    views of it without copying. On Linux several packets are taken in a single recvmmsg call"""
+
+    def __init__(self):
+        self.buffer = bytearray(RECV_SIZE * RECV_BATCH)  # One RECV_SIZE slot for each packet of a batch
+        self.view = memoryview(self.buffer)
+        self.names = [SockAddrIn() for _ in range(RECV_BATCH)]
+        slots = [(ctypes.c_char * RECV_SIZE).from_buffer(self.buffer, i * RECV_SIZE) for i in range(RECV_BATCH)]
+        self.iovecs = (IoVec * RECV_BATCH)(*[IoVec(ctypes.addressof(slot), RECV_SIZE) for slot in slots])
+        self.msgs = mmsg_array(self.iovecs, self.names)
+
+    def recv(self, sock):
+        """yields a (data, (host, port)) pair for each packet waiting on the socket. data is a view of the reused
+        buffer, so it is only valid until the next packet is taken. On Linux the socket is drained, calling recvmmsg
+        until it comes back with less than a full batch"""
+        if libc is None:
+            nbytes, address = sock.recvfrom_into(self.buffer, RECV_SIZE)
+            yield self.view[:nbytes], address
+            return
+
+        count = RECV_BATCH
+        while count == RECV_BATCH:
+            count = libc.recvmmsg(sock.fileno(), self.msgs, RECV_BATCH, socket.MSG_DONTWAIT, None)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err in (errno.EAGAIN, errno.EWOULDBLOCK):  # Nothing more is waiting
+                    return
+                raise OSError(err, os.strerror(err))
+            for i in range(count):
+                name = self.names[i]
+                address = (socket.inet_ntoa(struct.pack('=I', name.sin_addr)), socket.ntohs(name.sin_port))
+                start = i * RECV_SIZE
+                yield self.view[start:start + self.msgs[i].msg_len], address
+
+
+class PacketSender:
+    """Sends packets to each of a fixed list of (host, port) addresses through a single socket. The socket is opened
+    and the addresses converted to sockaddr_in structures once, and on Linux each round of packets is handed to the
+    kernel together in a single sendmmsg call"""
+
+    def __init__(self, addresses):
+        self.sock = init_output_socket()
+        self.addresses = addresses
+        self.names = [sockaddr_in(address) for address in addresses]
+        self.iovecs = (IoVec * len(addresses))()  # Pointed at each round of packets in turn
+        self.msgs = mmsg_array(self.iovecs, self.names)
+
+    def send(self, packets):
+        """sends each packet, a bytes object, to the address in the same position"""
+        if libc is None:
+            for packet, address in zip(packets, self.addresses):
+                self.sock.sendto(packet, address)
+            return
+
+        count = len(packets)
+        for iovec, packet in zip(self.iovecs, packets):  # The kernel reads the packets in place, without a copy
+            iovec.iov_base = ctypes.cast(packet, ctypes.c_void_p)
+            iovec.iov_len = len(packet)
+
+        sent = 0
+        while sent < count:  # sendmmsg may send fewer datagrams than asked, so carries on from where it stopped
+            result = libc.sendmmsg(self.sock.fileno(), ctypes.byref(self.msgs, sent * ctypes.sizeof(MMsgHdr)),
+                                   count - sent, 0)
+            if result < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            sent += result
 
 
 def error_msg(error_code):
     """Returns an error message associated with the number error_code"""
-    error_text = {
-        0: "Please enter a value between 1 and 64000",
-        1: "Your input ports do not match your output ports. Please update your configuration file",
-        2: "Please make sure you do not have the same entry in your input and output port fields",
-        3: "Please make sure your port numbers are between 1024 and 64000",
-        4: "Failed to initialise sockets",
-        10: "Packet contains less than one RIP Entry",
-        11: "RIP Packet header incorrect",
-        12: "Packet contains fragments",
-        13: "Given metric is out of range",
-        20: "An error on the socket"
-    }
-    return error_text[error_code]
+    return ERROR_TEXT[error_code]
 
 
-def read_config(file):
+def parse_config(file):
     """reads a .ini file intended as a config file for a router. If the .ini file has the expected format and
-    information an RIP entry is created with the router id, and lists of the input and output port numbers."""
-    config = ConfigParser()  # Creates an instance of the config parser
-    config.read(file)  # Config parser reads the given router file
+    information returns the router id, the input port numbers and a (router id, output port, metric) tuple for each
+    output. The result is cached until the file changes so reloading an unchanged file skips the parsing."""
+    stat = os.stat(file)
+    key = (os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+    if key in config_cache:
+        return config_cache[key]
+
+    config = {}
+    with open(file) as config_file:  # Reads the given router file
+        for line in config_file:
+            line = line.strip()
+            if line and line[0] not in '#;[':  # Skips blank lines, comments and the [router] section header
+                name, value = line.split('=', 1)
+                config[name.strip()] = value.strip()
 
     # Router ID
-    router_num = int(config['router']['router_id'])  # Extracts router id from config file
-    if 1 >= router_num >= 64000:  # Checks id is a valid id
+    router_num = int(config['router_id'])  # Extracts router id from config file
+    if not 1 <= router_num <= 64000:  # Checks id is a valid id
         sys.exit(error_msg(0))  # Error
 
     # Input ports
-    inputs = config['router']['input_ports'].split(', ')  # Extracts input ports from config file
-    input_ports = []
-    neighbours = []
-
-    for entry in inputs:
-        entry = int(entry)
-        if 1024 < entry < 64000:  # Checks input port is valid
-            input_ports.append(entry)  # If valid, appends to list fo input ports
-            neighbours.append(
-                int((entry - (router_num * 1000)) / 100))  # Finds the router id of the neighbouring router
-        else:
-
-            sys.exit(error_msg(0))  # Error
+    input_ports = list(map(int, config['input_ports'].split(', ')))  # Extracts input ports from config file
+    if min(input_ports) <= 1024 or max(input_ports) >= 64000:  # Checks input ports are valid
+        sys.exit(error_msg(0))  # Error
+    base = router_num * 1000
+    neighbours = [(entry - base) // 100 for entry in input_ports]  # Finds the router ids of the neighbouring routers
+    input_set = set(input_ports)  # Sets of the ports and neighbours for the membership checks on each output
+    neighbour_set = set(neighbours)
 
     # Outputs
-    out = config['router']['outputs'].split(', ')  # Extracts outputs from the config file
-    output_ports = []
-    rip_entries = []  # A list of RipEntry obj, one for each router that this router is aware of
-    rip_entries.append(RipEntry(router_num, 0, router_num, time.time()))
+    out = config['outputs'].split(', ')  # Extracts outputs from the config file
+    outputs = []
 
     for entry in out:
-        re_result = re.search("(.*)-(.)-(.)", entry).groups()  # Uses a regex to split the values of the entry
-        output_port, metric, router_id = [int(i) for i in re_result]  # Changes all values to ints
+        # Splits the port-metric-router_id entry and changes all values to ints
+        output_port, metric, router_id = map(int, entry.split('-'))
         if 1024 <= output_port <= 64000:  # Checks port number is valid
-            if output_port not in input_ports:  # Checks this port number is not also an input port
-                if router_id in neighbours:  # Checks that the output port has a matching input port for that router
-                    output_ports.append((router_id, output_port))
-                    rip_entries.append(RipEntry(router_id, metric, 0, time.time()))
+            if output_port not in input_set:  # Checks this port number is not also an input port
+                if router_id in neighbour_set:  # Checks that the output port has a matching input port for that router
+                    outputs.append((router_id, output_port, metric))
                 else:
                     sys.exit(error_msg(1))  # Error
             else:
@@ -91,21 +279,31 @@ def read_config(file):
         else:
             sys.exit(error_msg(3))  # Error
 
+    config_cache[key] = router_num, tuple(input_ports), tuple(outputs)
+    return config_cache[key]
+
+
+def read_config(file):
+    """reads a router config file and creates an RIP entry for this router and each of its neighbours, along with the
+    input sockets and a list of the (router id, output port) pairs for its neighbours."""
+    router_num, input_ports, outputs = parse_config(file)
+    output_ports = []
+    now = time.monotonic()
+    rip_entries = RoutingTable([RipEntry(router_num, 0, router_num, now)])
+
+    for router_id, output_port, metric in outputs:
+        output_ports.append((router_id, output_port))
+        rip_entries.append(RipEntry(router_id, metric, 0, now))
+
     sockets = init_sockets(input_ports)  # A list of sockets that this router is neighbouring
     return sockets, output_ports, rip_entries
 
 
 def rip_packet(rip_entries, receiver):
-    """taking a list of the entries in an rip table, builds a byte array to send as a packet"""
-    packet = [2, 2, 0, 0]  # The RIP header
-    for entry in rip_entries:
-        real_metric = entry.metric
-        if entry.next_hop == receiver:
-            entry.metric = 16
-        packet += entry.build_packet()  # a bytearray representing each RIP Entry
-        entry.metric = real_metric
-    byte_packet = bytearray(packet)
-    return byte_packet  # returns the entire packet as a bytearray
+    """taking a list of the entries in an rip table, builds the bytes to send as a packet. Routes learned from the
+    receiver are advertised to it as unreachable"""
+    return b''.join([RIP_HEADER] + [entry.unreachable_packet if entry.next_hop == receiver
+                                    else entry.build_packet() for entry in rip_entries])
 
 
 def init_sockets(inputs):
@@ -114,79 +312,141 @@ def init_sockets(inputs):
         for i in range(len(inputs)):
             sockets += [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]  # opens a sockets for each supplied input
         for i, sock in enumerate(sockets):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER_SIZE)
             sock.bind(('localhost', inputs[i]))
+            if ON_LINUX:
+                try:  # Raising the busy poll time needs CAP_NET_ADMIN, without it the socket simply does not poll
+                    sock.setsockopt(socket.SOL_SOCKET, SO_BUSY_POLL, BUSY_POLL_USECS)
+                except OSError:
+                    pass
             print("socket on port " + str(inputs[i]) + " initialised")
     except socket.error:
         sys.exit(error_msg(4))  # Error. Socket could not be bound.
     return sockets
 
 
+def init_affinity(core_env):
+    """pins the router to the CPU named by the environment variable core_env, if it is set, so its packets are
+    always handled on the same core"""
+    core = os.environ.get(core_env)
+    if core is None or not hasattr(os, 'sched_setaffinity'):  # Pinning is only available on Linux
+        return
+    try:
+        os.sched_setaffinity(0, {int(core)})
+    except (ValueError, OSError):
+        sys.exit(error_msg(5))  # Error. Not a CPU the router can run on.
+
+
+def init_output_socket():
+    """opens the unbound socket used to send updates to every neighbour"""
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    except socket.error:
+        sys.exit(error_msg(4))  # Error. Socket could not be opened.
+    return sock
+
+
+def sockaddr_in(address):
+    """converts a numeric (host, port) address into a sockaddr_in structure"""
+    host, port = address
+    addr = struct.unpack('=I', socket.inet_aton(host))[0]
+    return SockAddrIn(socket.AF_INET, socket.htons(port), addr)
+
+
+def mmsg_array(iovecs, names):
+    """builds an array of mmsghdr structures for sendmmsg or recvmmsg, one for each iovec and the sockaddr_in in the
+    same position. The iovecs and names must be kept alive for as long as the array is used"""
+    count = len(iovecs)
+    msgs = (MMsgHdr * count)()
+    for i in range(count):
+        msgs[i].msg_hdr.msg_name = ctypes.addressof(names[i])
+        msgs[i].msg_hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+    return msgs
+
+
 def format_check(rec_packet):
-    """Returns True if the received packet is formatted correctly, otherwise provides an error message and False"""
-    if len(rec_packet) < 4:  # packet contains at least one RIP entry
+    """Returns True if the received packet is formatted correctly: a RIP header followed by at least one whole RIP
+    entry, and no fragments"""
+    return (len(rec_packet) >= 24
+            and HEADER_WORD.unpack_from(rec_packet)[0] == RIP_HEADER_VALUE
+            and (len(rec_packet) - 4) % 20 == 0)
+
+
+def log_bad_packet(rec_packet):
+    """prints an error message explaining why the received packet failed format_check"""
+    if len(rec_packet) < 24:  # packet contains at least one RIP entry
         print(error_msg(10))
-    elif rec_packet[0:4] != b'\2\2\0\0':  # Packet header is correct
+    elif HEADER_WORD.unpack_from(rec_packet)[0] != RIP_HEADER_VALUE:  # Packet header is correct
         print(error_msg(11))
-    elif (len(rec_packet) - 4) % 20 != 0:  # Packet contains RIP entries of correct size
+    else:  # Packet contains RIP entries of correct size
         print(error_msg(12))
-    else:
-        return True
-    return False
 
 
-def update_table(rec_packet, routing_table, index=24):
-    """updates routing table to be in accordance with the received packet"""
-    sender = rec_packet[11]
-    current_routers = []
-    # First the router will go through its own routing table, reset the timer for the router it just received a packet
-    # from, and if that router had been unreachable it changes it so that it is now reachable
-    for entry in routing_table:
-        current_routers += [entry.router_id]
-        if entry.router_id == sender:
-            entry.timer = time.time()
-            if entry.metric == 16:
-                while index < len(rec_packet):
-                    if rec_packet[index+7] == routing_table[0].router_id:
-                        entry.metric = rec_packet[index+19]
-                        entry.timer = time.time()
-                        entry.next_hop = 0
-                        break
-                    index += 20
-                print('contact made with previously unreachable router', entry.router_id)
-            metric_to_sender = entry.metric
+def update_table(rec_packet, routing_table, now):
+    """updates routing table to be in accordance with the received packet, which arrived at the time now"""
+    packet = memoryview(rec_packet)  # Lets the entries be unpacked in place without copying them out of the packet
+    sender = RIP_ENTRY.unpack_from(packet, 4)[0]  # The first entry is the sending router itself
+    # The (router id, metric) pairs of the rest of the entries, decoded as they are iterated over
+    rec_entries = RIP_ENTRY.iter_unpack(packet[24:])
+    by_id = routing_table.by_id
+    own_id = routing_table[0].router_id
+    # First the router will reset the timer for the router it just received a packet from, and if that router had
+    # been unreachable it changes it so that it is now reachable
+    entry = by_id[sender]
+    routing_table.set_timer(entry, now)
+    if entry.metric == 16:
+        for router_id, metric in RIP_ENTRY.iter_unpack(packet[24:]):  # Leaves rec_entries for the merge below
+            if router_id == own_id:
+                entry.metric = metric
+                routing_table.set_timer(entry, now)
+                entry.next_hop = 0
+                routing_table.changed = True
+                break
+        print('contact made with previously unreachable router', entry.router_id)
+    metric_to_sender = entry.metric
 
     # Next the router goes through the received packet and updates its routing table to agree with it.
-    index = 24
-    while index < len(rec_packet):
-        id = rec_packet[index+7]
-        metric = rec_packet[index+19] + metric_to_sender
-        if id in current_routers:
-            for entry in routing_table:
-                if entry.router_id == id:
-                    if metric >= 16 and entry.next_hop == sender:
-                        entry.metric = 16
-                        entry.timer = 0
-                    else:
-                        if id != routing_table[0].router_id and entry.next_hop == sender:
-                            entry.timer = time.time()
-                        if entry.metric > metric:
-                            entry.metric = metric
-                            entry.next_hop = sender
+    for id, metric in rec_entries:
+        metric += metric_to_sender
+        entry = by_id.get(id)
+        if entry is not None:
+            if metric >= 16 and entry.next_hop == sender:
+                if entry.metric != 16:
+                    entry.metric = 16
+                    routing_table.changed = True
+                entry.timer = 0
+            else:
+                if id != own_id and entry.next_hop == sender:
+                    routing_table.set_timer(entry, now)
+                if entry.metric > metric:
+                    entry.metric = metric
+                    entry.next_hop = sender
+                    routing_table.changed = True
         else:
             # This entry is regarding a new router
-            routing_table.append(RipEntry(id, metric, sender, time.time()))
-        index += 20
+            routing_table.append(RipEntry(id, metric, sender, now))
 
     return routing_table
 
 
-def timeout_check(routing_table):
-    """Checks the routing table for timeouts and if one is found, metric to that router is set to unreachable"""
-    for entry in routing_table:
-        if entry.timer != 0 and entry.timer < time.time() - 30:
+def timeout_check(routing_table, now):
+    """Checks the routing table for timeouts at the time now and if one is found, metric to that router is set to
+    unreachable. Only the timers that have reached their time out are looked at"""
+    deadlines = routing_table.deadlines
+    while deadlines and deadlines[0][0] < now:
+        _, router_id = heapq.heappop(deadlines)
+        routing_table.scheduled.remove(router_id)
+        entry = routing_table.by_id[router_id]
+        if entry.timer != 0 and entry.timer + ROUTE_TIMEOUT < now:
             print("timeout on router", entry.router_id)
             entry.metric = 16
             entry.timer = 0
+            routing_table.changed = True
+        else:  # The timer has been restarted or stopped since, so its time out moves on, if it has one
+            routing_table.schedule(entry)
     return routing_table
 
 
@@ -200,39 +460,50 @@ def print_routing_table(routing_table):
 def mainloop():
     """mainloop of the program"""
     filename = sys.argv[1]  # Holds the variable given in the command line
+    init_affinity(CORE_ENV)
     sockets, outputs, routing_table = read_config(filename)  # Produces these variable from the given file
-    output_socks = []
+    packet_sender = PacketSender([(LOCALHOST, output[1]) for output in outputs])  # Sends to all of the neighbours
+    receiver = PacketReceiver()
+    selector = selectors.DefaultSelector()  # Waits on all of the input sockets at once (epoll on Linux)
+    for sock in sockets:
+        selector.register(sock, selectors.EVENT_READ)
     # The router informs its neighbours of its own existence
-    for i, output in enumerate(outputs):
-        output_socks += [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]
-        output_socks[i].sendto(rip_packet(routing_table, output[0]), ('localhost', output[1]))
+    packet_sender.send([routing_table.packet(output[0]) for output in outputs])
 
     print_routing_table(routing_table)
+    next_update = time.monotonic() + UPDATE_INTERVAL
 
     while 1:
-        if routing_table[0].timer < time.time() - 10:  # router checks its own timer for timeout
-            routing_table[0].timer = time.time()
+        now = time.monotonic()  # Read once and shared by everything done before waiting again
+        if now >= next_update:  # router checks whether its periodic update is due
+            next_update += UPDATE_INTERVAL
+            if next_update <= now:  # Updates missed while the router was held up are not all sent at once
+                next_update = now + UPDATE_INTERVAL
+            routing_table.set_timer(routing_table[0], now)
             # If so the router prints out its current routing table and sends it to its neighbours
             print("Periodic Update")
             print_routing_table(routing_table)
-            for i, sock in enumerate(output_socks):
-                sock.sendto(rip_packet(routing_table, outputs[i][0]), ('localhost', outputs[i][1]))
+            packet_sender.send([routing_table.packet(output[0]) for output in outputs])
 
-        routing_table = timeout_check(routing_table)
+        routing_table = timeout_check(routing_table, now)
         try:
-            # The router then waits for updates
-            readable, _, _ = select.select(sockets, [], [], 1)
-            for read in readable:  # For each socket within the list of sockets
-                data, sender_addr = read.recvfrom(1024)
-                data = bytearray(data)
-
-                # Router checks the new packet format and if it is different from current routing table
-                if format_check(data):
-                    print("packet received from router", data[11], str(sender_addr))
-                    routing_table = update_table(data, routing_table)
-
-        except socket.error():
-            error_msg(20)
+            # The router then waits for updates, until its next periodic update or route time out is due
+            wake = next_update
+            if routing_table.deadlines:
+                wake = min(wake, routing_table.deadlines[0][0])
+            events = selector.select(max(0, wake - now))
+            now = time.monotonic()  # The arrival time given to all of the packets just received
+            for key, _ in events:  # For each socket that has a packet waiting
+                for data, sender_addr in receiver.recv(key.fileobj):  # Takes every packet queued on the socket
+                    # Router checks the new packet format before merging it into its routing table
+                    if format_check(data):
+                        print("packet received from router", RIP_ENTRY.unpack_from(data, 4)[0], str(sender_addr))
+                        routing_table = update_table(data, routing_table, now)
+                    else:
+                        log_bad_packet(data)
+
+        except socket.error:
+            print(error_msg(20))
 
 
 mainloop()